@@ -1,13 +1,16 @@
 import streamlit as st
 import pandas as pd
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
+import io
+import orjson
 from msal import ConfidentialClientApplication
 from dotenv import load_dotenv
 import os
-from typing import List, Dict, Optional
 import time
+from typing import List, Dict, Optional, Tuple
 
 try:
     from streamlit_quill import st_quill
@@ -15,43 +18,127 @@ try:
 except ImportError:
     RICH_TEXT_AVAILABLE = False
 
-import email
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from email import policy
+from email.parser import BytesParser
 import re
+import html
 import random
 import string
 import datetime
+import functools
 
-# Load environment variables
-load_dotenv()
+@st.cache_resource(show_spinner=False)
+def get_azure_config() -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Load the Azure app registration settings once per process"""
+    # Load environment variables
+    load_dotenv()
+    return os.getenv('AZURE_CLIENT_ID'), os.getenv('AZURE_CLIENT_SECRET'), os.getenv('AZURE_TENANT_ID')
+
+# Streamlit re-executes this module on every rerun; the cached config makes
+# these lookups instead of re-reading .env and the environment each time
+AZURE_CLIENT_ID, AZURE_CLIENT_SECRET, AZURE_TENANT_ID = get_azure_config()
+_AZURE_CONFIGURED = all([AZURE_CLIENT_ID, AZURE_CLIENT_SECRET, AZURE_TENANT_ID])
+
+# Graph JSON batching: at most 20 requests per call, and the combined body has
+# to stay under the ~4 MB request limit, which matters once attachments are added
+GRAPH_BATCH_URL = "https://graph.microsoft.com/v1.0/$batch"
+GRAPH_BATCH_LIMIT = 20
+GRAPH_BATCH_MAX_BYTES = 4 * 1024 * 1024
+# Batches are packed to this size, leaving headroom below the hard limit
+GRAPH_BATCH_TARGET_BYTES = GRAPH_BATCH_MAX_BYTES - 256 * 1024
+
+# Times a $batch re-sends the requests Graph throttled (429) inside it
+GRAPH_BATCH_THROTTLE_RETRIES = 3
+
+@st.cache_resource(show_spinner=False)
+def get_graph_session() -> requests.Session:
+    """Create the pooled Graph HTTP session once per process, shared by all reruns"""
+    # Streamlit re-executes this script on every rerun, so a plain module-level
+    # session would be rebuilt (and its keep-alive connections dropped) each time.
+    # Only throttled (429) and unavailable (503) responses are retried: Graph has
+    # not accepted the request in either case. Read errors, 504s and other 5xx
+    # are never retried for POSTs since the emails may already have been sent.
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=4,
+        max_retries=Retry(
+            total=3,
+            read=0,
+            other=0,
+            backoff_factor=0.3,
+            status_forcelist=[429, 503],
+            allowed_methods=frozenset(["POST"]),
+            raise_on_status=False
+        )
+    ))
+    return session
+
+def _retry_after_seconds(headers: Dict, default: float = 1.0) -> float:
+    """Return the delay Graph asked for in a throttled response's headers"""
+    for name, value in headers.items():
+        if name.lower() == 'retry-after':
+            try:
+                return max(float(value), 0.0)
+            except (TypeError, ValueError):
+                break
+    return default
+
+def build_file_attachment(name: str, data: bytes) -> Dict:
+    """Build a Graph fileAttachment, base64-encoding the file contents"""
+    return {
+        "@odata.type": "#microsoft.graph.fileAttachment",
+        "name": name,
+        "contentType": "application/octet-stream",
+        "contentBytes": base64.b64encode(data).decode('ascii')
+    }
+
+def build_cc_recipients(cc_emails_input: str) -> Optional[List[Dict]]:
+    """Parse one CC address per line into Graph ccRecipients entries"""
+    addresses = (line.strip() for line in cc_emails_input.split('\n'))
+    return [{"emailAddress": {"address": address}} for address in addresses if address] or None
+
+@st.cache_resource(show_spinner=False)
+def get_msal_app(client_id: str, client_secret: str, authority: str) -> ConfidentialClientApplication:
+    """Create the MSAL app once per process instead of once per rerun"""
+    return ConfidentialClientApplication(
+        client_id=client_id,
+        client_credential=client_secret,
+        authority=authority
+    )
 
 class AzureGraphClient:
     def __init__(self):
-        self.client_id = os.getenv('AZURE_CLIENT_ID')
-        self.client_secret = os.getenv('AZURE_CLIENT_SECRET')
-        self.tenant_id = os.getenv('AZURE_TENANT_ID')
+        self.client_id = AZURE_CLIENT_ID
+        self.client_secret = AZURE_CLIENT_SECRET
+        self.tenant_id = AZURE_TENANT_ID
         self.authority = f"https://login.microsoftonline.com/{self.tenant_id}"
         self.scope = ["https://graph.microsoft.com/.default"]
         self.access_token = None
+        self.auth_headers = {}
+        self.token_expiry = 0.0
         
-        # Initialize MSAL app
-        self.app = ConfidentialClientApplication(
-            client_id=self.client_id,
-            client_credential=self.client_secret,
-            authority=self.authority
-        )
+        # Shared MSAL app, so its token cache survives Streamlit reruns
+        self.app = get_msal_app(self.client_id, self.client_secret, self.authority)
     
     def get_access_token(self):
         """Get access token for Microsoft Graph API"""
+        # Keep using the token we hold until five minutes before it expires
+        if self.access_token and time.monotonic() < self.token_expiry:
+            return True
+        
         try:
-            result = self.app.acquire_token_silent(self.scope, account=None)
-            
-            if not result:
-                result = self.app.acquire_token_for_client(scopes=self.scope)
+            # Checks MSAL's own token cache before going to Azure AD
+            result = self.app.acquire_token_for_client(scopes=self.scope)
             
             if "access_token" in result:
                 self.access_token = result["access_token"]
+                self.token_expiry = time.monotonic() + result.get("expires_in", 3600) - 300
+                # Built once per token rather than on every request
+                self.auth_headers = {
+                    'Authorization': f'Bearer {self.access_token}',
+                    'Content-Type': 'application/json'
+                }
                 return True
             else:
                 st.error(f"Failed to get access token: {result.get('error_description', 'Unknown error')}")
@@ -60,15 +147,9 @@ class AzureGraphClient:
             st.error(f"Error getting access token: {str(e)}")
             return False
     
-    def send_email(self, from_email: str, to_email: str, cc_emails: List[str], 
-                   subject: str, body: str, attachment_data: Optional[bytes] = None, 
-                   attachment_name: Optional[str] = None) -> bool:
-        """Send email using Microsoft Graph API"""
-        if not self.access_token:
-            if not self.get_access_token():
-                return False
-        
-        # Prepare email message
+    def _build_message(self, to_email: str, cc_recipients: Optional[List[Dict]], subject: str, body: str,
+                       attachments: Optional[List[Dict]] = None) -> Dict:
+        """Build the Graph message resource for a single email"""
         message = {
             "subject": subject,
             "body": {
@@ -84,39 +165,41 @@ class AzureGraphClient:
             ]
         }
         
-        # Add CC recipients if provided
-        if cc_emails:
-            message["ccRecipients"] = [
-                {"emailAddress": {"address": email}} for email in cc_emails if email.strip()
-            ]
+        # Add CC recipients if provided (prebuilt once, shared by every message)
+        if cc_recipients:
+            message["ccRecipients"] = cc_recipients
         
         # Add attachment if provided
-        if attachment_data and attachment_name:
-            attachment_base64 = base64.b64encode(attachment_data).decode('utf-8')
-            message["attachments"] = [
-                {
-                    "@odata.type": "#microsoft.graph.fileAttachment",
-                    "name": attachment_name,
-                    "contentType": "application/octet-stream",
-                    "contentBytes": attachment_base64
-                }
-            ]
+        if attachments:
+            message["attachments"] = attachments
+        
+        return message
+    
+    def _post(self, url: str, payload: Dict) -> requests.Response:
+        """POST a JSON payload to Graph over the shared session"""
+        # orjson encodes the large base64 attachment strings much faster than
+        # the stdlib json that requests' json= uses; throttled requests are
+        # retried by the session's Retry policy
+        return get_graph_session().post(url, headers=self.auth_headers, data=orjson.dumps(payload))
+    
+    def send_email(self, from_email: str, to_email: str, cc_recipients: Optional[List[Dict]], 
+                   subject: str, body: str, attachments: Optional[List[Dict]] = None) -> bool:
+        """Send email using Microsoft Graph API"""
+        if not self.get_access_token():
+            return False
+        
+        message = self._build_message(to_email, cc_recipients, subject, body, attachments)
         
         # API endpoint
         url = f"https://graph.microsoft.com/v1.0/users/{from_email}/sendMail"
         
-        headers = {
-            'Authorization': f'Bearer {self.access_token}',
-            'Content-Type': 'application/json'
-        }
-        
         payload = {
             "message": message,
             "saveToSentItems": "true"
         }
         
         try:
-            response = requests.post(url, headers=headers, data=json.dumps(payload))
+            response = self._post(url, payload)
             
             if response.status_code == 202:
                 return True
@@ -127,175 +210,369 @@ class AzureGraphClient:
         except Exception as e:
             st.error(f"Error sending email to {to_email}: {str(e)}")
             return False
-
-def replace_template_variables(template: str, replacements: Dict[str, str], is_html: bool = False) -> str:
-    """Replace template variables with actual values"""
-    result = template
     
-    if is_html:
-        # For HTML content, we need to be more careful about replacements
-        # Handle HTML-encoded placeholders and preserve HTML structure
-        import html
+    def _batch_request(self, request_id: str, from_email: str, message: Dict) -> Dict:
+        """Wrap a message as one sendMail sub-request of a $batch call"""
+        return {
+            "id": request_id,
+            "method": "POST",
+            "url": f"/users/{from_email}/sendMail",
+            "headers": {"Content-Type": "application/json"},
+            "body": {
+                "message": message,
+                "saveToSentItems": "true"
+            }
+        }
+    
+    def plan_batches(self, from_email: str, email_specs: List[Dict]) -> List[List[int]]:
+        """Group spec indexes into $batch calls that stay under Graph's limits"""
+        # '{"requests":[' and ']}' around the comma-separated sub-requests
+        envelope_size = len(orjson.dumps({"requests": []}))
+        attachment_sizes = {}
+        batches = []
+        batch_bytes = 0
         
-        for key, value in replacements.items():
-            placeholder = f"<{key}>"
-            safe_value = str(value) if value else ""
+        for index, spec in enumerate(email_specs):
+            attachments = spec.get("attachments")
+            message = self._build_message(**{**spec, "attachments": None})
+            # Longest id a sub-request can get, plus its separating comma
+            request = self._batch_request(str(GRAPH_BATCH_LIMIT - 1), from_email, message)
+            size = len(orjson.dumps(request)) + 1
             
-            # Try multiple replacement patterns for HTML content
-            # 1. Direct replacement
-            result = result.replace(placeholder, safe_value)
+            # A shared attachments list is encoded once and its length reused
+            if attachments:
+                if id(attachments) not in attachment_sizes:
+                    attachment_sizes[id(attachments)] = len(',"attachments":') + len(orjson.dumps(attachments))
+                size += attachment_sizes[id(attachments)]
             
-            # 2. HTML-encoded replacement (&lt; and &gt;)
-            encoded_placeholder = html.escape(placeholder)
-            result = result.replace(encoded_placeholder, safe_value)
-            
-            # 3. Handle placeholders that might be split across tags
-            # Look for patterns like <span><{key}></span> or similar
-            pattern = rf'(<[^>]*>)*\s*<\s*{re.escape(key)}\s*>\s*(<[^>]*>)*'
-            result = re.sub(pattern, safe_value, result, flags=re.IGNORECASE)
+            if batches and len(batches[-1]) < GRAPH_BATCH_LIMIT and batch_bytes + size <= GRAPH_BATCH_TARGET_BYTES:
+                batches[-1].append(index)
+                batch_bytes += size
+            else:
+                batches.append([index])
+                batch_bytes = envelope_size + size
+        
+        return batches
+    
+    def send_emails_batch(self, from_email: str, email_specs: List[Dict]) -> List[Tuple[bool, str]]:
+        """Send up to GRAPH_BATCH_LIMIT emails in one $batch, one (success, error) per spec"""
+        if not email_specs:
+            return []
+        
+        # Free while the token is valid; renews it if a long campaign outlives it
+        if not self.get_access_token():
+            return [(False, "Not authenticated with Azure Graph API")] * len(email_specs)
+        
+        messages = [self._build_message(**spec) for spec in email_specs]
+        results = [(False, "No response for this request in the batch")] * len(email_specs)
+        pending = list(range(len(email_specs)))
+        
+        try:
+            for attempt in range(GRAPH_BATCH_THROTTLE_RETRIES + 1):
+                payload = {
+                    "requests": [self._batch_request(str(i), from_email, messages[i]) for i in pending]
+                }
+                
+                response = self._post(GRAPH_BATCH_URL, payload)
+                
+                if response.status_code != 200:
+                    error = f"Batch status: {response.status_code}, Response: {response.text}"
+                    for i in pending:
+                        results[i] = (False, error)
+                    return results
+                
+                # The batch itself succeeds even when Graph throttles some of
+                # its requests, so those are collected and resent on their own
+                throttled = []
+                retry_after = 0.0
+                
+                # Sub-responses may come back in any order; match them up by id
+                for item in orjson.loads(response.content).get("responses", []):
+                    index = int(item["id"])
+                    status = item.get("status")
+                    if status == 202:
+                        results[index] = (True, "")
+                    elif status == 429 and attempt < GRAPH_BATCH_THROTTLE_RETRIES:
+                        throttled.append(index)
+                        retry_after = max(retry_after, _retry_after_seconds(item.get("headers") or {}))
+                    else:
+                        error = item.get("body", {}).get("error", {}).get("message", "Unknown error")
+                        results[index] = (False, f"Status: {status}, Response: {error}")
+                
+                if not throttled:
+                    break
+                
+                time.sleep(retry_after)
+                pending = sorted(throttled)
             
-            # 4. Handle placeholders with extra whitespace
-            spaced_placeholder = f"< {key} >"
-            result = result.replace(spaced_placeholder, safe_value)
+            return results
             
-    else:
-        # Plain text replacement (original logic)
-        for key, value in replacements.items():
-            placeholder = f"<{key}>"
-            result = result.replace(placeholder, str(value) if value else "")
+        except Exception as e:
+            for i in pending:
+                if not results[i][0]:
+                    results[i] = (False, str(e))
+            return results
+
+# Compiled placeholder patterns, keyed by (column names, is_html). The column
+# set only changes when a new sheet is uploaded, so this stays tiny.
+@functools.lru_cache(maxsize=16)
+def _compile_placeholder_pattern(keys: Tuple[str, ...], is_html: bool) -> re.Pattern:
+    """Compile the placeholder union regex for a tuple of column names"""
+    # Longest names first so the alternation tries the most specific key first
+    keys_sorted = sorted(keys, key=len, reverse=True)
     
-    return result
+    if is_html:
+        # Also matches HTML-encoded (&lt;column&gt;) and padded (< column >) forms
+        variants = dict.fromkeys(variant for key in keys_sorted for variant in (key, html.escape(key)))
+        alternation = "|".join(re.escape(variant) for variant in variants)
+        # Case-insensitive, as HTML placeholders have always been matched
+        return re.compile(rf"(?:<|&lt;)\s*({alternation})\s*(?:>|&gt;)", re.IGNORECASE)
+    
+    alternation = "|".join(re.escape(key) for key in keys_sorted)
+    return re.compile(f"<({alternation})>")
+
+def build_placeholder_pattern(columns, is_html: bool = False) -> re.Pattern:
+    """Return a single regex that matches any <column> placeholder"""
+    return _compile_placeholder_pattern(tuple(str(column) for column in columns), is_html)
+
+@functools.lru_cache(maxsize=16)
+def _placeholder_keys(keys: Tuple) -> Tuple[Dict, Dict]:
+    """Map placeholder names, exact and casefolded, back to the original keys"""
+    by_name = {str(key): key for key in keys}
+    by_folded = {}
+    for name, key in by_name.items():
+        by_folded.setdefault(name.casefold(), key)
+    return by_name, by_folded
+
+def resolve_placeholder(name: str, keys, is_html: bool = False):
+    """Return the column key a matched placeholder name refers to, or None"""
+    # The pattern matches str(column); map back to the original (e.g. numeric) key
+    by_name, by_folded = _placeholder_keys(tuple(keys))
+    if name in by_name:
+        return by_name[name]
+    if not is_html:
+        return None
+    # HTML placeholders may be HTML-encoded and match in any letter case
+    name = html.unescape(name)
+    if name in by_name:
+        return by_name[name]
+    return by_folded.get(name.casefold())
+
+def replace_template_variables(template: str, replacements: Dict[str, str], is_html: bool = False) -> str:
+    """Replace template variables with actual values"""
+    # Every placeholder form is substituted in one regex pass over the template
+    pattern = build_placeholder_pattern(replacements, is_html=is_html)
+    keys = tuple(replacements)
+    
+    def substitute(match):
+        key = resolve_placeholder(match.group(1), keys, is_html)
+        if key is None:
+            return match.group(0)
+        value = replacements[key]
+        return str(value) if value else ""
+    
+    return pattern.sub(substitute, template)
+
+# Patterns used by convert_to_html and parse_eml_file, compiled once at
+# import instead of being looked up in re's cache for every email
+_RE_HTML_TAG = re.compile(r'</?html[^>]*>', re.IGNORECASE)
+_RE_BODY_TAG = re.compile(r'</?body[^>]*>', re.IGNORECASE)
+_RE_HEAD_TAG = re.compile(r'</?head[^>]*>', re.IGNORECASE)
+_RE_META_TAG = re.compile(r'<meta[^>]*>', re.IGNORECASE)
+_RE_BOLD_STAR = re.compile(r'\*\*(.*?)\*\*')
+_RE_BOLD_UNDER = re.compile(r'__(.*?)__')
+_RE_ITAL_STAR = re.compile(r'(?<!\*)\*([^*]+?)\*(?!\*)')
+_RE_ITAL_UNDER = re.compile(r'(?<!_)_([^_]+?)_(?!_)')
+_RE_LINK = re.compile(r'\[([^\]]+)\]\(([^)]+)\)')
+_RE_URL = re.compile(r'(?<!href=")(?<!href=\')(?<!<a href=")(?<!<a href=\')(?<!>)https?://[^\s<>"\']+(?!["\']>)(?!</a>)')
+_RE_MULTI_NL = re.compile(r'\n{3,}')
+_RE_EML_BODY = re.compile(r'<body[^>]*>(.*?)</body>', re.DOTALL | re.IGNORECASE)
+_RE_EML_WIDTH = re.compile(r'width\s*:\s*[^;}"\'\s]*[;"\']', re.IGNORECASE)
+_RE_EML_MAX_WIDTH = re.compile(r'max-width\s*:\s*[^;}"\'\s]*[;"\']', re.IGNORECASE)
+
+# Fixed document wrapper around every email body; only the <body> style differs
+_HTML_DOC_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+</head>
+"""
+_HTML_RICH_HEAD = _HTML_DOC_HEAD + """<body style="margin: 0; padding: 0;">
+    <div>
+        """
+_HTML_PLAIN_HEAD = _HTML_DOC_HEAD + """<body style="margin: 0; padding: 10px; font-family: Arial, sans-serif; font-size: 14px; line-height: 1.4;">
+    <div>
+        """
+_HTML_TAIL = """
+    </div>
+</body>
+</html>"""
 
 def convert_to_html(text: str, is_html: bool = False) -> str:
     """Convert plain text or HTML to formatted HTML email"""
     if not text:
         return ""
     
-    import re
-    
     if is_html:
         # Text is already HTML (from rich text editor or EML)
         html_text = text
         
         # Clean up any existing body/html tags to avoid nesting
-        html_text = re.sub(r'</?html[^>]*>', '', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'</?body[^>]*>', '', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'</?head[^>]*>', '', html_text, flags=re.IGNORECASE)
-        html_text = re.sub(r'<meta[^>]*>', '', html_text, flags=re.IGNORECASE)
+        html_text = _RE_HTML_TAG.sub('', html_text)
+        html_text = _RE_BODY_TAG.sub('', html_text)
+        html_text = _RE_HEAD_TAG.sub('', html_text)
+        html_text = _RE_META_TAG.sub('', html_text)
         
         # Remove any extra whitespace but preserve intentional formatting
         html_text = html_text.strip()
         
         # Wrap in minimal email structure without overriding styles
-        html_text = f"""<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-</head>
-<body style="margin: 0; padding: 0;">
-    <div>
-        {html_text}
-    </div>
-</body>
-</html>"""
-        return html_text
+        return _HTML_RICH_HEAD + html_text + _HTML_TAIL
     
     # Handle plain text with markdown formatting while preserving structure
     html_text = text
     
     # Convert markdown-style formatting to HTML
+    # (each pattern needs its marker character, so skip the ones that can't match)
     # Bold text: **text** or __text__ -> <strong>text</strong>
-    html_text = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', html_text)
-    html_text = re.sub(r'__(.*?)__', r'<strong>\1</strong>', html_text)
+    if '**' in html_text:
+        html_text = _RE_BOLD_STAR.sub(r'<strong>\1</strong>', html_text)
+    if '__' in html_text:
+        html_text = _RE_BOLD_UNDER.sub(r'<strong>\1</strong>', html_text)
     
     # Italic text: *text* or _text_ -> <em>text</em>
-    html_text = re.sub(r'(?<!\*)\*([^*]+?)\*(?!\*)', r'<em>\1</em>', html_text)
-    html_text = re.sub(r'(?<!_)_([^_]+?)_(?!_)', r'<em>\1</em>', html_text)
+    if '*' in html_text:
+        html_text = _RE_ITAL_STAR.sub(r'<em>\1</em>', html_text)
+    if '_' in html_text:
+        html_text = _RE_ITAL_UNDER.sub(r'<em>\1</em>', html_text)
     
     # Convert hyperlink syntax [text](url) to HTML links
-    hyperlink_pattern = r'\[([^\]]+)\]\(([^)]+)\)'
-    html_text = re.sub(hyperlink_pattern, r'<a href="\2" style="color: #0066cc; text-decoration: underline;">\1</a>', html_text)
+    # (cheap substring checks skip the regex engine when nothing can match)
+    if '](' in html_text:
+        html_text = _RE_LINK.sub(r'<a href="\2" style="color: #0066cc; text-decoration: underline;">\1</a>', html_text)
     
     # Convert simple URLs to clickable links
-    url_pattern = r'(?<!href=")(?<!href=\')(?<!<a href=")(?<!<a href=\')(?<!>)https?://[^\s<>"\']+(?!["\']>)(?!</a>)'
-    html_text = re.sub(url_pattern, r'<a href="\g<0>" style="color: #0066cc; text-decoration: underline;">\g<0></a>', html_text)
+    if 'http://' in html_text or 'https://' in html_text:
+        html_text = _RE_URL.sub(r'<a href="\g<0>" style="color: #0066cc; text-decoration: underline;">\g<0></a>', html_text)
     
     # Preserve exact line breaks and spacing
     # Replace newlines with <br> tags but handle multiple consecutive newlines properly
-    html_text = re.sub(r'\n{3,}', '\n\n', html_text)  # Limit excessive line breaks
+    html_text = _RE_MULTI_NL.sub('\n\n', html_text)  # Limit excessive line breaks
     html_text = html_text.replace('\n', '<br>\n')
     
     # Wrap in minimal HTML structure without imposed styling
-    html_text = f"""<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-</head>
-<body style="margin: 0; padding: 10px; font-family: Arial, sans-serif; font-size: 14px; line-height: 1.4;">
-    <div>
-        {html_text}
-    </div>
-</body>
-</html>"""
+    return _HTML_PLAIN_HEAD + html_text + _HTML_TAIL
+
+def render_template_column(template: str, df: pd.DataFrame, is_html: bool = False) -> List[str]:
+    """Substitute placeholders for every row of df in one vectorized pass"""
+    pattern = build_placeholder_pattern(df.columns, is_html=is_html)
+    
+    # Split once and concatenate column-wise, giving the same strings as
+    # replace_template_variables per row: [text, key, text, key, ..., text]
+    parts = pattern.split(template)
     
-    return html_text
+    result = pd.Series([parts[0]] * len(df), index=df.index, dtype=object)
+    column_text = {}
+    
+    for i in range(1, len(parts), 2):
+        column = resolve_placeholder(parts[i], df.columns, is_html)
+        
+        if column not in column_text:
+            column_text[column] = df[column].map(lambda value: str(value) if value else "").astype(object)
+        
+        result = result + column_text[column] + parts[i + 1]
+    
+    return result.tolist()
+
+# Text the plain-text conversion acts on (emphasis, [text](url) links, URLs,
+# line breaks); a column value containing any of it has to be converted after
+# substitution. Any bracket or parenthesis can open, close or split a link.
+_RE_CONVERTIBLE_VALUE = re.compile(r'[*_\[\]()]|https?://|\n')
+
+def prepare_body_template(email_template: str, is_html: bool, df: pd.DataFrame) -> Optional[str]:
+    """Convert the body template to HTML once; None means convert per recipient"""
+    pattern = build_placeholder_pattern(df.columns, is_html=is_html)
+    referenced = {}
+    
+    for match in pattern.finditer(email_template):
+        referenced[resolve_placeholder(match.group(1), df.columns, is_html)] = True
+        
+        if not is_html:
+            # A URL running into the placeholder would be autolinked with the value
+            before = email_template[:match.start()]
+            after = email_template[match.end():]
+            word_before = before.rsplit(None, 1)[-1] if before and not before[-1].isspace() else ""
+            word_after = after.split(None, 1)[0] if after and not after[0].isspace() else ""
+            if 'http' in word_before or 'http' in word_after:
+                return None
+    
+    # Blanks and text the conversion acts on must be converted after substitution
+    for column in referenced:
+        values = df[column].map(lambda value: str(value) if value else "")
+        if is_html:
+            # Only tag cleanup and trimming happen for HTML templates
+            unsafe = values.str.contains('<', regex=False) | (values.str.strip() != values)
+        else:
+            unsafe = values.str.contains(_RE_CONVERTIBLE_VALUE)
+        if (unsafe | (values == "")).any():
+            return None
+    
+    # The conversion must leave every placeholder intact
+    converted = convert_to_html(email_template, is_html=is_html)
+    if pattern.findall(converted) != pattern.findall(email_template):
+        return None
+    return converted
+
+def render_email_body(email_template: str, contact_data: Dict, is_html: bool,
+                      body_template_html: Optional[str] = None) -> str:
+    """Render the final HTML email body for one contact"""
+    if body_template_html is not None:
+        # Template already converted: only the placeholders are left to fill in
+        return replace_template_variables(body_template_html, contact_data, is_html=is_html)
+    
+    body = replace_template_variables(email_template, contact_data, is_html=is_html)
+    return convert_to_html(body, is_html=is_html)
+
+def _eml_part_text(part) -> str:
+    """Return a body part's decoded text, tolerating missing or unknown charsets"""
+    # Without a declared charset get_content() assumes us-ascii and mangles
+    # 8-bit text; charsets Python doesn't know raise LookupError. Both read
+    # the raw bytes as UTF-8 instead.
+    if part.get_content_charset() is not None:
+        try:
+            return part.get_content()
+        except LookupError:
+            pass
+    return part.get_payload(decode=True).decode('utf-8', errors='ignore')
 
+@st.cache_data(show_spinner=False)
 def parse_eml_file(eml_content: bytes) -> Dict[str, str]:
     """Parse EML file and extract subject, HTML body, and plain text body"""
     try:
-        # Parse the email message
-        msg = email.message_from_bytes(eml_content)
+        # The default policy decodes headers and body parts to str for us
+        msg = BytesParser(policy=policy.default).parsebytes(eml_content)
         
         # Extract subject
-        subject = msg.get('Subject', '')
-        if subject:
-            # Decode subject if it's encoded
-            from email.header import decode_header
-            decoded_subject = decode_header(subject)
-            subject = ''.join([
-                text.decode(encoding or 'utf-8') if isinstance(text, bytes) else text
-                for text, encoding in decoded_subject
-            ])
-        
-        # Extract body content
-        html_body = ""
-        plain_body = ""
-        
-        if msg.is_multipart():
-            # Handle multipart messages
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                content_disposition = str(part.get("Content-Disposition"))
-                
-                # Skip attachments
-                if "attachment" in content_disposition:
-                    continue
-                    
-                if content_type == "text/plain":
-                    plain_body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                elif content_type == "text/html":
-                    html_body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-        else:
-            # Handle simple messages
-            content_type = msg.get_content_type()
-            if content_type == "text/plain":
-                plain_body = msg.get_payload(decode=True).decode('utf-8', errors='ignore')
-            elif content_type == "text/html":
-                html_body = msg.get_payload(decode=True).decode('utf-8', errors='ignore')
+        subject = msg['Subject'] or ''
+        
+        # Extract body content; get_body() skips attachments
+        html_part = msg.get_body(preferencelist=('html',))
+        plain_part = msg.get_body(preferencelist=('plain',))
+        html_body = _eml_part_text(html_part) if html_part else ""
+        plain_body = _eml_part_text(plain_part) if plain_part else ""
         
         # Clean up HTML body if present
         if html_body:
             # Keep only the main content between <body> tags if present
-            body_match = re.search(r'<body[^>]*>(.*?)</body>', html_body, re.DOTALL | re.IGNORECASE)
+            body_match = _RE_EML_BODY.search(html_body)
             if body_match:
                 html_body = body_match.group(1)
             
             # Remove only problematic style attributes, keep formatting ones
             # Remove only width/height constraints that might break in different clients
-            html_body = re.sub(r'width\s*:\s*[^;}"\'\s]*[;"\']', '', html_body, flags=re.IGNORECASE)
-            html_body = re.sub(r'max-width\s*:\s*[^;}"\'\s]*[;"\']', '', html_body, flags=re.IGNORECASE)
+            html_body = _RE_EML_WIDTH.sub('', html_body)
+            html_body = _RE_EML_MAX_WIDTH.sub('', html_body)
             
             # Preserve all other formatting and spacing
             html_body = html_body.strip()
@@ -310,6 +587,42 @@ def parse_eml_file(eml_content: bytes) -> Dict[str, str]:
         st.error(f"Error parsing EML file: {str(e)}")
         return {'subject': '', 'html_body': '', 'plain_body': ''}
 
+OTP_EMAIL_SUBJECT = "Email Automation - Sender Verification OTP"
+
+# Static OTP email body; filled in with str.format at send time
+OTP_EMAIL_TEMPLATE = """
+<html>
+<body style="font-family: Arial, sans-serif; line-height: 1.6;">
+    <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
+        <h2 style="color: #2E86AB;">Covvalent Email Automation</h2>
+        <h3>Sender Email Verification</h3>
+        
+        <p>Someone is trying to use <strong>{target_email}</strong> as a sender email in the Covvalent Email Automation tool.</p>
+        
+        <div style="background-color: #f0f8ff; padding: 20px; border-radius: 5px; margin: 20px 0;">
+            <h2 style="color: #2E86AB; text-align: center; font-size: 32px; margin: 10px 0;">
+                {otp}
+            </h2>
+            <p style="text-align: center; margin: 5px 0;"><strong>Your verification code</strong></p>
+        </div>
+        
+        <p><strong>Instructions:</strong></p>
+        <ul>
+            <li>Enter this 6-digit code in the Email Automation app</li>
+            <li>This code expires in 10 minutes</li>
+            <li>If you didn't request this, please ignore this email</li>
+        </ul>
+        
+        <hr style="margin: 30px 0; border: none; border-top: 1px solid #ddd;">
+        <p style="font-size: 12px; color: #666;">
+            This is an automated message from Covvalent Email Automation Tool.<br>
+            For security purposes, please do not share this code with anyone.
+        </p>
+    </div>
+</body>
+</html>
+"""
+
 class OTPVerification:
     """Handle OTP verification for sender email authorization"""
     
@@ -324,45 +637,13 @@ class OTPVerification:
     def send_otp(self, target_email: str, otp: str) -> bool:
         """Send OTP from authorized sender to target email"""
         try:
-            subject = "Email Automation - Sender Verification OTP"
-            body = f"""
-            <html>
-            <body style="font-family: Arial, sans-serif; line-height: 1.6;">
-                <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
-                    <h2 style="color: #2E86AB;">Covvalent Email Automation</h2>
-                    <h3>Sender Email Verification</h3>
-                    
-                    <p>Someone is trying to use <strong>{target_email}</strong> as a sender email in the Covvalent Email Automation tool.</p>
-                    
-                    <div style="background-color: #f0f8ff; padding: 20px; border-radius: 5px; margin: 20px 0;">
-                        <h2 style="color: #2E86AB; text-align: center; font-size: 32px; margin: 10px 0;">
-                            {otp}
-                        </h2>
-                        <p style="text-align: center; margin: 5px 0;"><strong>Your verification code</strong></p>
-                    </div>
-                    
-                    <p><strong>Instructions:</strong></p>
-                    <ul>
-                        <li>Enter this 6-digit code in the Email Automation app</li>
-                        <li>This code expires in 10 minutes</li>
-                        <li>If you didn't request this, please ignore this email</li>
-                    </ul>
-                    
-                    <hr style="margin: 30px 0; border: none; border-top: 1px solid #ddd;">
-                    <p style="font-size: 12px; color: #666;">
-                        This is an automated message from Covvalent Email Automation Tool.<br>
-                        For security purposes, please do not share this code with anyone.
-                    </p>
-                </div>
-            </body>
-            </html>
-            """
+            body = OTP_EMAIL_TEMPLATE.format(target_email=target_email, otp=otp)
             
             success = self.graph_client.send_email(
                 from_email=self.authorized_sender,
                 to_email=target_email,
-                cc_emails=[],
-                subject=subject,
+                cc_recipients=None,
+                subject=OTP_EMAIL_SUBJECT,
                 body=body
             )
             
@@ -381,6 +662,11 @@ class OTPVerification:
         # Check if OTP matches
         return entered_otp.strip() == stored_otp.strip()
 
+@st.cache_data(show_spinner=False)
+def load_contacts_excel(file_bytes: bytes) -> pd.DataFrame:
+    """Read the uploaded contact spreadsheet, cached by file content across reruns"""
+    return pd.read_excel(io.BytesIO(file_bytes), engine='calamine')
+
 def validate_excel_columns(df: pd.DataFrame) -> bool:
     """Validate that the Excel file has required columns"""
     required_columns = ['Company Name', 'Company Email', 'Customer Name']
@@ -392,6 +678,60 @@ def validate_excel_columns(df: pd.DataFrame) -> bool:
         return False
     return True
 
+MAX_PREVIEW_CONTACTS = 100
+
+# Send-loop status updates: refresh interval in seconds and lines kept on screen
+UI_REFRESH_INTERVAL = 0.5
+UI_LOG_LINES = 20
+
+def format_send_log(entries: List[Tuple[str, bool, str]]) -> str:
+    """Render send results as markdown lines, one per recipient"""
+    return "  \n".join(
+        f"✅ Email sent to {name}" if ok else f"❌ Failed to send email to {name}. {error}"
+        for name, ok, error in entries
+    )
+
+@st.fragment
+def render_email_preview(df: pd.DataFrame, subject_template: str, email_template: str,
+                         is_rich_text: bool):
+    """Render the email preview for one contact, rerunning only this panel"""
+    st.header("👀 Email Preview")
+    
+    # Only offer the first few contacts so the dropdown stays responsive on large sheets
+    preview_df = df.head(MAX_PREVIEW_CONTACTS)
+    preview_records = preview_df.to_dict(orient='records')
+    # Option labels in one column-wise pass rather than a lookup per option
+    labels = [
+        f"{name} - {company}"
+        for name, company in zip(preview_df['Customer Name'].astype(str), preview_df['Company Name'].astype(str))
+    ]
+    
+    preview_index = st.selectbox(
+        f"Select contact for preview (first {len(labels)}):",
+        range(len(labels)),
+        format_func=lambda x: labels[x]
+    )
+    
+    if preview_index is not None:
+        preview_data = preview_records[preview_index]
+        
+        preview_subject = replace_template_variables(subject_template, preview_data, is_html=False)
+        preview_body = replace_template_variables(email_template, preview_data, is_html=is_rich_text)
+        preview_body_html = convert_to_html(preview_body, is_html=is_rich_text)
+        
+        st.subheader("Subject:")
+        st.code(preview_subject)
+        
+        if is_rich_text:
+            st.subheader("Email Preview (What recipients will see):")
+            st.components.v1.html(preview_body_html, height=400, scrolling=True)
+        else:
+            st.subheader("Body (Preview):")
+            st.markdown(preview_body)
+            
+            st.subheader("HTML Email Body (What recipients will see):")
+            st.components.v1.html(preview_body_html, height=300, scrolling=True)
+
 def main():
     st.set_page_config(
         page_title="Email Automation App", 
@@ -407,7 +747,7 @@ def main():
     st.sidebar.header("Configuration")
     
     # Check if environment variables are set
-    if not all([os.getenv('AZURE_CLIENT_ID'), os.getenv('AZURE_CLIENT_SECRET'), os.getenv('AZURE_TENANT_ID')]):
+    if not _AZURE_CONFIGURED:
         st.error("Please configure your Azure credentials in the .env file")
         st.info("Copy .env.example to .env and fill in your Azure app registration details")
         return
@@ -563,7 +903,7 @@ def main():
         
         if uploaded_excel:
             try:
-                df = pd.read_excel(uploaded_excel)
+                df = load_contacts_excel(uploaded_excel.getvalue())
                 st.success(f"Excel file loaded successfully! Found {len(df)} contacts.")
                 
                 if validate_excel_columns(df):
@@ -589,9 +929,13 @@ def main():
             help="This file will be attached to all emails"
         )
         
+        # Read the upload once; getvalue() copies the whole buffer on every call
+        attachment_bytes = uploaded_attachment.getvalue() if uploaded_attachment else None
+        attachment_name = uploaded_attachment.name if uploaded_attachment else None
+        
         if uploaded_attachment:
-            st.success(f"Attachment uploaded: {uploaded_attachment.name}")
-            st.info(f"File size: {len(uploaded_attachment.getvalue())} bytes")
+            st.success(f"Attachment uploaded: {attachment_name}")
+            st.info(f"File size: {len(attachment_bytes)} bytes")
     
     # Email configuration
     st.header("✉️ Email Configuration")
@@ -620,7 +964,8 @@ def main():
             help="One email per line"
         )
         
-        cc_emails = [email.strip() for email in cc_emails_input.split('\n') if email.strip()]
+        # Built once; every message in the campaign reuses the same recipient list
+        cc_recipients = build_cc_recipients(cc_emails_input)
     
     # Email template
     st.header("📝 Email Template")
@@ -653,7 +998,7 @@ def main():
         )
         
         if uploaded_eml:
-            eml_data = parse_eml_file(uploaded_eml.read())
+            eml_data = parse_eml_file(uploaded_eml.getvalue())
             
             if eml_data['subject'] or eml_data['html_body'] or eml_data['plain_body']:
                 st.success("✅ EML file loaded successfully!")
@@ -778,33 +1123,7 @@ Best regards,
     
     # Preview section
     if df is not None and email_template and subject_template:
-        st.header("👀 Email Preview")
-        
-        preview_index = st.selectbox(
-            "Select contact for preview:",
-            range(len(df)),
-            format_func=lambda x: f"{df.iloc[x]['Customer Name']} - {df.iloc[x]['Company Name']}"
-        )
-        
-        if preview_index is not None:
-            preview_data = df.iloc[preview_index].to_dict()
-            
-            preview_subject = replace_template_variables(subject_template, preview_data, is_html=False)
-            preview_body = replace_template_variables(email_template, preview_data, is_html=is_rich_text)
-            preview_body_html = convert_to_html(preview_body, is_html=is_rich_text)
-            
-            st.subheader("Subject:")
-            st.code(preview_subject)
-            
-            if is_rich_text:
-                st.subheader("Email Preview (What recipients will see):")
-                st.components.v1.html(preview_body_html, height=400, scrolling=True)
-            else:
-                st.subheader("Body (Preview):")
-                st.markdown(preview_body)
-                
-                st.subheader("HTML Email Body (What recipients will see):")
-                st.components.v1.html(preview_body_html, height=300, scrolling=True)
+        render_email_preview(df, subject_template, email_template, is_rich_text)
     
     # Send emails section
     st.header("🚀 Send Emails")
@@ -812,8 +1131,16 @@ Best regards,
     # Show batch size information
     if df is not None:
         batch_size = len(df)
-        estimated_time = batch_size * (0.5 if batch_size > 100 else 1) / 60  # minutes
-        st.info(f"**Batch Info:** {batch_size} recipients | Estimated time: {estimated_time:.1f} minutes")
+        # Each copy of the attachment is base64-encoded into its message, so large
+        # files mean fewer emails per batch; bodies only add to this, so the
+        # estimate is a lower bound (plan_batches sizes the real batches)
+        emails_per_batch = GRAPH_BATCH_LIMIT
+        if attachment_bytes:
+            encoded_size = 4 * -(-len(attachment_bytes) // 3)
+            emails_per_batch = max(1, min(GRAPH_BATCH_LIMIT, GRAPH_BATCH_TARGET_BYTES // encoded_size))
+        batch_count = -(-batch_size // emails_per_batch)
+        estimated_time = batch_count * 2 / 60  # minutes, ~2s per sequential $batch call
+        st.info(f"**Batch Info:** {batch_size} recipients | Estimated time: at least {estimated_time:.1f} minutes")
         
         if batch_size > 500:
             st.warning("⚠️ Large batch detected. Consider splitting into smaller batches for better reliability.")
@@ -842,58 +1169,94 @@ Best regards,
         successful_sends = 0
         failed_sends = 0
         
-        for index, row in df.iterrows():
+        # Build contact dicts straight from itertuples: no per-row Series and
+        # none of to_dict()'s per-cell conversion to native Python types
+        columns = df.columns.tolist()
+        records = [dict(zip(columns, row)) for row in df.itertuples(index=False, name=None)]
+        
+        # Encode the attachment once; every message shares the same attachments list
+        attachments = None
+        if attachment_bytes:
+            attachments = [build_file_attachment(attachment_name, attachment_bytes)]
+        
+        # Convert the body template to HTML once instead of once per recipient
+        body_template_html = prepare_body_template(email_template, is_rich_text, df)
+        
+        # Fill in subjects, and bodies when pre-converted, for all contacts in one vectorized pass
+        subjects = render_template_column(subject_template, df, is_html=False)
+        bodies = None
+        if body_template_html is not None:
+            bodies = render_template_column(body_template_html, df, is_html=is_rich_text)
+        
+        # Per-recipient results are collected here and shown through a single
+        # placeholder, refreshed at most every UI_REFRESH_INTERVAL seconds
+        send_log: List[Tuple[str, bool, str]] = []
+        
+        # Expand the templates for every contact first; sending happens in batches below
+        prepared = []
+        for index, contact_data in enumerate(records):
             try:
-                # Prepare email data
-                contact_data = row.to_dict()
-                final_subject = replace_template_variables(subject_template, contact_data, is_html=False)
-                final_body = replace_template_variables(email_template, contact_data, is_html=is_rich_text)
-                final_body_html = convert_to_html(final_body, is_html=is_rich_text)
-                
-                # Get attachment data if available
-                attachment_data = None
-                attachment_name = None
-                if uploaded_attachment:
-                    attachment_data = uploaded_attachment.getvalue()
-                    attachment_name = uploaded_attachment.name
-                
-                # Send email
-                with status_container:
-                    st.write(f"Sending email to {row['Customer Name']} at {row['Company Email']}...")
-                
-                success = graph_client.send_email(
-                    from_email=st.session_state.verified_sender,
-                    to_email=row['Company Email'],
-                    cc_emails=cc_emails,
-                    subject=final_subject,
-                    body=final_body_html,
-                    attachment_data=attachment_data,
-                    attachment_name=attachment_name
-                )
+                final_subject = subjects[index]
+                if bodies is not None:
+                    final_body_html = bodies[index]
+                else:
+                    final_body_html = render_email_body(email_template, contact_data, is_rich_text)
                 
+                prepared.append((contact_data, {
+                    # itertuples keeps numpy scalars, which orjson can't serialize
+                    "to_email": str(contact_data['Company Email']),
+                    "cc_recipients": cc_recipients,
+                    "subject": final_subject,
+                    "body": final_body_html,
+                    "attachments": attachments
+                }))
+            except Exception as e:
+                failed_sends += 1
+                send_log.append((contact_data['Customer Name'], False, f"Error preparing email: {str(e)}"))
+        
+        # Graph caps a $batch at 20 requests and ~4 MB; batches are packed by
+        # the encoded size of each message, attachments included
+        batch_plan = graph_client.plan_batches(st.session_state.verified_sender, [spec for _, spec in prepared])
+        batches = [[prepared[index] for index in group] for group in batch_plan]
+        
+        with status_container:
+            st.write(f"Sending {len(prepared)} emails in {len(batches)} batches...")
+            log_placeholder = st.empty()
+        
+        last_ui_update = 0.0
+        
+        # One batch at a time, by design: Graph allows 4 concurrent requests per
+        # mailbox and counts each sub-request of a batch against that limit, so
+        # sending batches from a thread pool would only trade speed for 429s
+        completed = 0
+        for batch in batches:
+            batch_results = graph_client.send_emails_batch(
+                from_email=st.session_state.verified_sender,
+                email_specs=[spec for _, spec in batch]
+            )
+            
+            for (contact_data, _), (success, error) in zip(batch, batch_results):
                 if success:
                     successful_sends += 1
-                    with status_container:
-                        st.success(f"✅ Email sent to {row['Customer Name']}")
                 else:
                     failed_sends += 1
-                    with status_container:
-                        st.error(f"❌ Failed to send email to {row['Customer Name']}")
-                
-                # Update progress
-                progress = (index + 1) / len(df)
-                progress_bar.progress(progress)
-                
-                # Dynamic delay based on batch size to avoid rate limiting
-                if len(df) > 100:
-                    time.sleep(0.5)  # Faster for large batches
-                else:
-                    time.sleep(1)    # Conservative for small batches
-                
-            except Exception as e:
-                failed_sends += 1
-                with status_container:
-                    st.error(f"❌ Error sending to {row['Customer Name']}: {str(e)}")
+                send_log.append((contact_data['Customer Name'], success, error))
+            
+            completed += len(batch)
+            now = time.monotonic()
+            if now - last_ui_update >= UI_REFRESH_INTERVAL:
+                last_ui_update = now
+                log_placeholder.markdown(format_send_log(send_log[-UI_LOG_LINES:]))
+                progress_bar.progress(completed / len(prepared))
+        
+        # Final refresh so the last results are not lost to the throttle
+        log_placeholder.markdown(format_send_log(send_log[-UI_LOG_LINES:]))
+        progress_bar.progress(1.0)
+        
+        failures = [entry for entry in send_log if not entry[1]]
+        if failures:
+            with status_container.expander(f"❌ {len(failures)} failed emails"):
+                st.markdown(format_send_log(failures))
         
         # Final summary
         st.header("📊 Email Sending Summary")
@@ -909,7 +1272,7 @@ Best regards,
             st.success(f"Email campaign completed! {successful_sends} emails sent successfully.")
         
         if failed_sends > 0:
-            st.warning(f"{failed_sends} emails failed to send. Check the error messages above.")
+            st.warning(f"{failed_sends} emails failed to send. See the failed emails list above.")
 
 if __name__ == "__main__":
     main()